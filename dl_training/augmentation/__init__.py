@@ -14,8 +14,10 @@ Module that privides common spatial and intensity data augmentation tools.
 # Import
 from collections import namedtuple
 import copy
+import inspect
 import logging
 import numpy as np
+from .utils import get_rng
 from .spatial import affine
 from .spatial import flip
 from .spatial import deformation
@@ -36,9 +38,9 @@ class Transformer(object):
     """ Class that can be used to register a sequence of transformations.
     """
     Transform = namedtuple("Transform", ["transform", "params", "probability",
-                                         "apply_to", "with_channel"])
+                                         "apply_to", "with_channel", "with_rng"])
 
-    def __init__(self, with_channel=True, output_label=False):
+    def __init__(self, with_channel=True, output_label=False, rng=None):
         """ Initialize the class.
 
         Parameters
@@ -50,11 +52,18 @@ class Transformer(object):
         output_label: bool, default False
             if output data are labels, automatically force the interpolation
             to nearest neighboor via the 'order' transform parameter.
+        rng: numpy.random.Generator, default None
+            the random number generator used to draw the transformations and
+            given to the transformations accepting a 'rng' parameter. If not
+            specified, a new generator is seeded from the global NumPy random
+            state at each call.
         """
         self.transforms = []
+        self.probabilities = np.empty(0)
         self.dtype = "all"
         self.with_channel = with_channel
         self.output_label = output_label
+        self.rng = rng
 
 
     def register(self, transform, probability=1, apply_to=None, with_channel=False, **kwargs):
@@ -74,10 +83,12 @@ class Transformer(object):
         """
         if apply_to is None:
             apply_to = ["all"]
+        with_rng = "rng" in inspect.signature(transform).parameters
         trf = self.Transform(
             transform=transform, params=kwargs, probability=probability,
-            apply_to=apply_to, with_channel=with_channel)
+            apply_to=apply_to, with_channel=with_channel, with_rng=with_rng)
         self.transforms.append(trf)
+        self.probabilities = np.append(self.probabilities, probability)
 
     def __call__(self, arr):
         """ Apply the registered transformations.
@@ -97,14 +108,19 @@ class Transformer(object):
             transformed = arr.copy()
         if not self.with_channel:
             transformed = np.expand_dims(transformed, axis=0)
-        for trf in self.transforms:
+        rng = get_rng(self.rng)
+        # Draws at once whether each transformation is applied
+        applied = rng.random(len(self.transforms)) < self.probabilities
+        for trf, apply in zip(self.transforms, applied):
             if self.dtype not in trf.apply_to:
                 continue
             kwargs = copy.deepcopy(trf.params)
             if (self.output_label and self.dtype == "output" and
                     "order" in kwargs):
                 kwargs["order"] = 0
-            if np.random.rand() < trf.probability:
+            if trf.with_rng:
+                kwargs["rng"] = rng
+            if apply:
                 logger.debug("Applying {0}...".format(trf.transform))
                 if trf.with_channel:
                     transformed = trf.transform(transformed, **kwargs)
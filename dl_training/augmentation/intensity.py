@@ -6,13 +6,16 @@ Code: https://github.com/fepegar/torchio
 
 # Import
 import numbers
+from functools import lru_cache
 import numpy as np
 from scipy.ndimage import gaussian_filter
+from scipy.ndimage import correlate1d
 from scipy.spatial.transform import Rotation
 from scipy.ndimage import map_coordinates
 from .transform import compose
 from .transform import affine_flow
 from .utils import interval
+from .utils import get_rng
 
 
 
@@ -88,7 +91,30 @@ def add_offset(arr, factor):
     return transformed
 
 
-def add_blur(arr, snr=None, sigma=None):
+@lru_cache(maxsize=None)
+def gaussian_kernel1d(sigma, truncate=4.0):
+    """ Get a (cached) normalized 1D Gaussian kernel, as used by
+    scipy.ndimage.gaussian_filter. The returned array must not be modified.
+
+    Parameters
+    ----------
+    sigma: float
+        the standard deviation of the Gaussian kernel.
+    truncate: float, default 4.0
+        the kernel is truncated at this many standard deviations.
+
+    Returns
+    -------
+    kernel: array
+        the 1D Gaussian kernel.
+    """
+    radius = int(truncate * sigma + 0.5)
+    x = np.arange(-radius, radius + 1)
+    kernel = np.exp(-0.5 * (x / sigma) ** 2)
+    return kernel / kernel.sum()
+
+
+def add_blur(arr, snr=None, sigma=None, nb_bins=None, rng=None):
     """ Add random blur using a Gaussian filter.
 
     Parameters
@@ -100,6 +126,12 @@ def add_blur(arr, snr=None, sigma=None):
         for the noise distribution.
     sigma: float or 2-uplet
         the standard deviation for Gaussian kernel.
+    nb_bins: int, default None
+        if set, the standard deviation is drawn among 'nb_bins' evenly
+        spaced values in the sigma interval, whose separable kernels are
+        cached.
+    rng: numpy.random.Generator, default None
+        the random number generator.
 
     Returns
     -------
@@ -114,11 +146,18 @@ def add_blur(arr, snr=None, sigma=None):
         s0 = np.std(arr)
         sigma = s0 / snr
     sigma = interval(sigma, lower=0)
-    sigma_random = np.random.uniform(low=sigma[0], high=sigma[1], size=1)[0]
-    return gaussian_filter(arr, sigma_random)
+    if nb_bins is None:
+        sigma_random = get_rng(rng).uniform(low=sigma[0], high=sigma[1])
+        return gaussian_filter(arr, sigma_random)
+    sigma_random = np.linspace(sigma[0], sigma[1], nb_bins)[get_rng(rng).integers(nb_bins)]
+    kernel = gaussian_kernel1d(float(sigma_random))
+    transformed = arr
+    for axis in range(arr.ndim):
+        transformed = correlate1d(transformed, kernel, axis=axis, mode="reflect")
+    return transformed
 
 
-def add_noise(arr, snr=None, sigma=None, noise_type="gaussian"):
+def add_noise(arr, snr=None, sigma=None, noise_type="gaussian", rng=None):
     """ Add random Gaussian or Rician noise.
 
     The noise level can be specified directly by setting the standard
@@ -142,6 +181,8 @@ def add_noise(arr, snr=None, sigma=None, noise_type="gaussian"):
     noise_type: str, default 'gaussian'
         the distribution of added noise - can be either 'gaussian' for
         Gaussian distributed noise, or 'rician' for Rice-distributed noise.
+    rng: numpy.random.Generator, default None
+        the random number generator.
 
     Returns
     -------
@@ -155,9 +196,12 @@ def add_noise(arr, snr=None, sigma=None, noise_type="gaussian"):
     if snr is not None:
         s0 = np.std(arr)
         sigma = s0 / snr
+    rng = get_rng(rng)
     sigma = interval(sigma, lower=0)
-    sigma_random = np.random.uniform(low=sigma[0], high=sigma[1], size=1)[0]
-    noise = np.random.normal(0, sigma_random, [2] + list(arr.shape))
+    sigma_random = rng.uniform(low=sigma[0], high=sigma[1])
+    # the imaginary component is only needed for Rician noise
+    nb_components = 2 if noise_type == "rician" else 1
+    noise = rng.normal(0, sigma_random, [nb_components] + list(arr.shape))
     if noise_type == "gaussian":
         transformed = arr + noise[0]
     elif noise_type == "rician":
@@ -20,6 +20,7 @@ from .transform import compose
 from .transform import gaussian_random_field
 from .transform import affine_flow
 from .utils import interval
+from .utils import get_rng
 
 
 def affine(arr, rotation=10, translation=10, zoom=0.2, order=3, dist="uniform"):
@@ -70,11 +71,12 @@ def affine(arr, rotation=10, translation=10, zoom=0.2, order=3, dist="uniform"):
     transformed = map_coordinates(arr, locs, order=order, cval=0)
     return transformed.reshape(shape)
 
-def cutout(arr, patch_size=None, value=0, random_size=False, inplace=False, localization=None):
+def cutout(arr, patch_size=None, value=0, random_size=False, inplace=False, localization=None, rng=None):
     """Apply a cutout on the images
     cf. Improved Regularization of Convolutional Neural Networks with Cutout, arXiv, 2017
     We assume that the square to be cut is inside the image.
     """
+    rng = get_rng(rng)
     img_shape = np.array(arr.shape)
     if type(patch_size) == int:
         size = [patch_size for _ in range(len(img_shape))]
@@ -86,11 +88,11 @@ def cutout(arr, patch_size=None, value=0, random_size=False, inplace=False, loca
         if size[ndim] > img_shape[ndim] or size[ndim] < 0:
             size[ndim] = img_shape[ndim]
         if random_size:
-            size[ndim] = np.random.randint(0, size[ndim])
+            size[ndim] = rng.integers(0, size[ndim])
         if localization is not None:
             delta_before = max(localization[ndim] - size[ndim]//2, 0)
         else:
-            delta_before = np.random.randint(0, img_shape[ndim] - size[ndim] + 1)
+            delta_before = rng.integers(0, img_shape[ndim] - size[ndim] + 1)
         indexes.append(slice(delta_before, delta_before + size[ndim]))
     if inplace:
         arr[tuple(indexes)] = value
@@ -101,7 +103,7 @@ def cutout(arr, patch_size=None, value=0, random_size=False, inplace=False, loca
         return arr_cut
 
 
-def flip(arr, axis=None):
+def flip(arr, axis=None, rng=None):
     """ Apply a random mirror flip.
 
     Parameters
@@ -111,6 +113,8 @@ def flip(arr, axis=None):
     axis: int, default None
         apply flip on the specified axis. If not specified, randomize the
         flip axis.
+    rng: numpy.random.Generator, default None
+        the random number generator.
 
     Returns
     -------
@@ -118,7 +122,7 @@ def flip(arr, axis=None):
         the transformed input data.
     """
     if axis is None:
-        axis = np.random.randint(low=0, high=arr.ndim, size=1)[0]
+        axis = get_rng(rng).integers(low=0, high=arr.ndim)
     return np.flip(arr, axis=axis)
 
 
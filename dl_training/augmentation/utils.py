@@ -14,6 +14,7 @@ A module with common functions.
 
 # Import
 import numbers
+import numpy as np
 
 
 def interval(obj, lower=None):
@@ -44,3 +45,22 @@ def interval(obj, lower=None):
     if min_val > max_val:
         raise ValueError("Wrong interval boudaries.")
     return tuple(obj)
+
+
+def get_rng(rng=None):
+    """ Get a random number generator.
+
+    Parameters
+    ----------
+    rng: numpy.random.Generator, default None
+        the generator to use. If not specified, a new generator is seeded
+        from the global NumPy random state.
+
+    Returns
+    -------
+    rng: numpy.random.Generator
+        a random number generator.
+    """
+    if rng is None:
+        rng = np.random.default_rng(np.random.randint(2**31))
+    return rng
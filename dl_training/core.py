@@ -29,6 +29,19 @@ from dl_training.history import History
 import dl_training.metrics as mmetrics
 import logging
 
+
+def inference_mode():
+    """ Get a context manager disabling the gradients computation.
+
+    Returns
+    -------
+    context: context manager
+        torch.inference_mode, that also disables the view tracking and
+        version counters (PyTorch >= 1.9), or torch.no_grad.
+    """
+    return getattr(torch, "inference_mode", torch.no_grad)()
+
+
 class Base(object):
     """ Class to perform classification.
     """
@@ -133,6 +146,8 @@ class Base(object):
                                 self.logger.error('Error while loading the optimizer\'s weights: %s' % str(e))
                         else:
                             self.logger.warning("The optimizer's weights are not restored ! ")
+                    if load_optimizer:
+                        self.load_checkpoint_state(checkpoint)
                 else:
                     self.model.load_state_dict(checkpoint)
 
@@ -141,6 +156,28 @@ class Base(object):
 
         self.model = self.model.to(self.device)
 
+    def checkpoint_state(self):
+        """ Get the extra states (besides the model and optimizer weights)
+        saved in the checkpoints.
+
+        Returns
+        -------
+        state: dict
+            the states to save, restored by 'load_checkpoint_state'.
+        """
+        return dict()
+
+    def load_checkpoint_state(self, checkpoint):
+        """ Restore the extra states saved by 'checkpoint_state' from a
+        pretrained checkpoint.
+
+        Parameters
+        ----------
+        checkpoint: dict
+            the loaded checkpoint.
+        """
+        pass
+
     def training(self, manager, nb_epochs: int, checkpointdir=None,
                  fold_index=None, scheduler=None, with_validation=True,
                  nb_epochs_per_saving=1, exp_name=None, **kwargs_train):
@@ -219,7 +256,8 @@ class Base(object):
                         fold=fold,
                         outdir=checkpointdir,
                         name=exp_name,
-                        optimizer=self.optimizer)
+                        optimizer=self.optimizer,
+                        **self.checkpoint_state())
                     train_history.save(
                         outdir=checkpointdir,
                         epoch=epoch,
@@ -257,7 +295,7 @@ class Base(object):
 
         values = {}
         iteration = 0
-        losses = []
+        loss_sum = 0.
         y_pred = []
         y_true = []
         for dataitem in loader:
@@ -280,9 +318,10 @@ class Base(object):
             batch_loss.backward()
             self.optimizer.step()
 
-            losses.append(float(batch_loss))
-            y_pred.extend(outputs.detach().cpu().numpy())
-            y_true.extend(list_targets[0].detach().cpu().numpy())
+            loss_sum += float(batch_loss)
+            # Kept on device: a single transfer is done at the end of the epoch
+            y_pred.append(outputs.detach())
+            y_true.append(list_targets[0].detach())
 
             aux_losses = (self.model.get_aux_losses() if hasattr(self.model, 'get_aux_losses') else dict())
             aux_losses.update(self.loss.get_aux_losses() if hasattr(self.loss, 'get_aux_losses') else dict())
@@ -292,11 +331,13 @@ class Base(object):
                     values[name] = 0
                 values[name] += float(aux_loss) / nb_batch
             iteration += 1
-        loss = np.mean(losses)
+        loss = loss_sum / iteration if iteration > 0 else float("nan")
+        if len(y_pred) > 0:
+            y_pred, y_true = torch.cat(y_pred).cpu(), torch.cat(y_true).cpu()
         for name, metric in self.metrics.items():
             if name not in values:
                 values[name] = 0
-            values[name] = float(metric(torch.tensor(y_pred), torch.tensor(y_true)))
+            values[name] = float(metric(y_pred, y_true))
         pbar.close()
         return loss, values
 
@@ -359,9 +400,12 @@ class Base(object):
         loss = 0
         values = {}
         visuals = []
+        # The results are written in buffers pre-allocated at the first batch
+        nb_samples = len(loader.sampler)
+        (offset, offset_true) = (0, 0)
 
-        with torch.no_grad():
-            y, y_true, X = [], [], []
+        with inference_mode():
+            y, y_true, X = None, None, None
 
             for dataitem in loader:
                 pbar.update()
@@ -370,10 +414,14 @@ class Base(object):
                     inputs = inputs.to(self.device)
                 list_targets = []
                 targets = []
-                for item in (dataitem.outputs, dataitem.labels):
-                    if item is not None:
-                        targets.append(item.to(self.device))
-                        y_true.extend(item.cpu().detach().numpy())
+                items = [item for item in (dataitem.outputs, dataitem.labels) if item is not None]
+                for item in items:
+                    targets.append(item.to(self.device))
+                    item = item.cpu().detach().numpy()
+                    if y_true is None:
+                        y_true = np.empty((len(items) * nb_samples, *item.shape[1:]), dtype=item.dtype)
+                    y_true[offset_true:offset_true + len(item)] = item
+                    offset_true += len(item)
                 if len(targets) == 1:
                     targets = targets[0]
                 elif len(targets) == 0:
@@ -387,10 +435,18 @@ class Base(object):
                     batch_loss = self.loss(outputs, *list_targets)
                     loss += float(batch_loss) / nb_batch
 
-                y.extend(outputs.cpu().detach().numpy())
+                if y is None:
+                    y = torch.empty((nb_samples, *outputs.shape[1:]), dtype=outputs.dtype,
+                                    pin_memory=outputs.is_cuda)
+                y[offset:offset + len(outputs)].copy_(outputs.detach(), non_blocking=True)
 
                 if isinstance(inputs, torch.Tensor):
-                    X.extend(inputs.cpu().detach().numpy())
+                    # the inputs are taken from the loaded batch (no copy back from the device)
+                    x = dataitem.inputs.cpu().detach().numpy()
+                    if X is None:
+                        X = np.empty((nb_samples, *x.shape[1:]), dtype=x.dtype)
+                    X[offset:offset + len(x)] = x
+                offset += len(outputs)
 
                 aux_losses = (self.model.get_aux_losses() if hasattr(self.model, 'get_aux_losses') else dict())
                 aux_losses.update(self.loss.get_aux_losses() if hasattr(self.loss, 'get_aux_losses') else dict())
@@ -399,11 +455,18 @@ class Base(object):
                     if name not in values:
                         values[name] = 0
                     values[name] += aux_loss / nb_batch
-
-                # Now computes the metrics with (y, y_true)
-                for name, metric in self.metrics.items():
-                    name += " on validation set"
-                    values[name] = metric(torch.tensor(y), torch.tensor(y_true))
             pbar.close()
 
+        # Waits for the asynchronous copies to <y> before reading it
+        if self.device.type == "cuda":
+            torch.cuda.synchronize(self.device)
+        y = y[:offset].numpy() if y is not None else np.empty(0)
+        y_true = y_true[:offset_true] if y_true is not None else np.empty(0)
+        X = X[:offset] if X is not None else np.empty(0)
+
+        # Now computes the metrics with (y, y_true)
+        for name, metric in self.metrics.items():
+            name += " on validation set"
+            values[name] = metric(torch.from_numpy(y), torch.from_numpy(y_true))
+
         return y, y_true, X, loss, values
\ No newline at end of file
@@ -2,13 +2,15 @@ from datasets.open_bhb import OpenBHB, SubOpenBHB, Callable, List
 from datasets.bhb_10k import BHB
 from datasets.clinical_multisites import SCZDataset, BipolarDataset, ASDDataset, SubSCZDataset, \
     SubBipolarDataset, SubASDDataset
-from dl_training.self_supervision.sim_clr import SimCLROpenBHB, SimCLRSubOpenBHB
+from dl_training.self_supervision.sim_clr import SimCLROpenBHB, SimCLRSubOpenBHB, worker_init_fn
 from dl_training.transforms import Padding, Crop, Normalize, Standardize
 from torchvision.transforms.transforms import Compose
-from torch.utils.data import DataLoader, SequentialSampler, RandomSampler
+from torch.utils.data import DataLoader, SequentialSampler, RandomSampler, DistributedSampler
 from sklearn.base import TransformerMixin, BaseEstimator
 from sklearn.preprocessing import StandardScaler
 import torch, logging
+import torch.distributed as dist
+from inspect import signature
 from collections import namedtuple
 from dl_training.preprocessing.combat import CombatModel
 import numpy as np
@@ -44,6 +46,7 @@ class StandardScalerBiased(StandardScaler):
 
 
 class OpenBHBDataManager:
+    model = None
 
     def __init__(self, root: str, preproc: str, labels: List[str]=None, sampler: str="random",
                  batch_size: int=1, number_of_folds: int=None, N_train_max: int=None,
@@ -98,6 +101,10 @@ class OpenBHBDataManager:
         self.batch_size = batch_size
         self.device = device
         self.dataloader_kwargs = dataloader_kwargs
+        self.model = model
+        if model == "SimCLR":
+            # per-worker random generator for the data augmentations
+            self.dataloader_kwargs.setdefault("worker_init_fn", worker_init_fn)
 
     @staticmethod
     def collate_fn(list_samples):
@@ -173,6 +180,14 @@ class OpenBHBDataManager:
             if residualizer is None:
                 (residualizer, Zres) = self.fit_residualizer(tests_to_return+['train'], fold_index)
 
+        # the SimCLR embeddings are gathered across processes at each batch (see sim_clr.all_gather): each process
+        # loads its own part of the data, with the same number of samples on all of them
+        distributed = (self.model == "SimCLR" and dist.is_available() and dist.is_initialized())
+        sampler_kwargs = dict()
+        if distributed and "drop_last" in signature(DistributedSampler).parameters:
+            # no sample repeated to even out the parts (PyTorch >= 1.8)
+            sampler_kwargs["drop_last"] = True
+
         test_loaders = dict()
         for t in tests_to_return:
             dataset = self.dataset[t] if t != "validation" else self.dataset[t][fold_index]
@@ -183,7 +198,8 @@ class OpenBHBDataManager:
                 dataset = dataset.transform(residualizer, labels[["site"]].astype(object), mask=self.mask,
                                             discrete_covariates=labels[self.discrete_vars],
                                             continuous_covariates=labels[self.continuous_vars])
-            test_loaders[t] = DataLoader(dataset, batch_size=self.batch_size,
+            test_sampler = DistributedSampler(dataset, shuffle=False, **sampler_kwargs) if distributed else None
+            test_loaders[t] = DataLoader(dataset, batch_size=self.batch_size, sampler=test_sampler,
                                          collate_fn=OpenBHBDataManager.collate_fn,
                                          **self.dataloader_kwargs)
         if "test_intra" in test_loaders:
@@ -202,6 +218,9 @@ class OpenBHBDataManager:
                 dataset = dataset.transform(residualizer, labels[["site"]].astype(object),
                                             discrete_covariates=labels[self.discrete_vars],
                                             continuous_covariates=labels[self.continuous_vars], mask=self.mask)
+            if distributed:
+                # reshuffled at each epoch by SimCLR.train (set_epoch)
+                sampler = DistributedSampler(dataset, shuffle=(self.sampler == "random"), **sampler_kwargs)
             _train = DataLoader(
                 dataset, batch_size=self.batch_size, sampler=sampler,
                 collate_fn=OpenBHBDataManager.collate_fn,
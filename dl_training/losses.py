@@ -71,25 +71,24 @@ class WeaklySupervisedNTXenLoss(nn.Module):
     def forward(self, z_i, z_j, labels):
         N = len(z_i)
         assert N == len(labels), "Unexpected labels length: %i"%len(labels)
-        z_i = func.normalize(z_i, p=2, dim=-1) # dim [N, D]
-        z_j = func.normalize(z_j, p=2, dim=-1) # dim [N, D]
-        sim_zii= (z_i @ z_i.T) / self.temperature # dim [N, N] => Upper triangle contains incorrect pairs
-        sim_zjj = (z_j @ z_j.T) / self.temperature # dim [N, N] => Upper triangle contains incorrect pairs
-        sim_zij = (z_i @ z_j.T) / self.temperature # dim [N, N] => the diag contains the correct pairs (i,j) (x transforms via T_i and T_j)
+        z = func.normalize(torch.cat([z_i, z_j], dim=0), p=2, dim=-1) # dim [2N, D]
+        # [[sim_zii, sim_zij], [sim_zij.T, sim_zjj]] where the diag of sim_zij contains the correct pairs (i,j)
+        # (x transforms via T_i and T_j)
+        sim_Z = (z @ z.T) / self.temperature # dim [2N, 2N]
         # 'Remove' the diag terms by penalizing it (exp(-inf) = 0)
-        sim_zii = sim_zii - self.INF * torch.eye(N, device=z_i.device)
-        sim_zjj = sim_zjj - self.INF * torch.eye(N, device=z_i.device)
+        sim_Z.fill_diagonal_(-self.INF)
+        sim_zij = sim_Z[:N, N:]
 
         all_labels = labels.view(N, -1).repeat(2, 1).detach().cpu().numpy() # [2N, *]
         weights = self.kernel(all_labels, all_labels) # [2N, 2N]
         weights = weights * (1 - np.eye(2*N)) # puts 0 on the diagonal
         weights /= weights.sum(axis=1)
+        weights = torch.from_numpy(weights).to(device=z.device, dtype=z.dtype)
         # if 'rbf' kernel and sigma->0, we retrieve the classical NTXenLoss (without labels)
-        sim_Z = torch.cat([torch.cat([sim_zii, sim_zij], dim=1),
-                           torch.cat([sim_zij.T, sim_zjj], dim=1)], dim=0) # [2N, 2N]
-        log_sim_Z = func.log_softmax(sim_Z, dim=1)
-
-        loss = -1./N * (torch.from_numpy(weights).to(z_i.device) * log_sim_Z).sum()
+        # sum(weights * log_softmax(sim_Z)) expanded without materializing the [2N, 2N] log-probabilities:
+        # sum(weights * sim_Z) = sum(z * (weights @ z)) / temperature since the weights are 0 on the diag
+        log_norm = torch.logsumexp(sim_Z, dim=1) # [2N]
+        loss = -1./N * ((z * (weights @ z)).sum() / self.temperature - (weights.sum(dim=1) * log_norm).sum())
 
         correct_pairs = torch.arange(N, device=z_i.device).long()
 
@@ -42,12 +42,21 @@ if __name__=="__main__":
     # Dataloader: set them
     parser.add_argument("--num_cpu_workers", type=int, default=3, help="Number of workers assigned to do the "
                                                                        "preprocessing step (used by DataLoader of Pytorch)")
+    parser.add_argument("--prefetch_factor", type=int, default=4, help="Number of batches loaded in advance by "
+                                                                        "each DataLoader worker")
     parser.add_argument("--sampler", choices=["random", "weighted_random", "sequential"], required=True)
 
     parser.add_argument("--residualize", type=str, choices=["linear", "combat"])
 
     # Self-sypervised learning
     parser.add_argument("--sigma", type=float, help="Hyper-parameter for RBF kernel in self-supervised loss.", default=5)
+    parser.add_argument("--da_on_gpu", action="store_true", help="Applies the self-supervised data augmentations "
+                                                                   "on GPU per batch instead of in the DataLoader")
+    parser.add_argument("--use_amp", action="store_true", help="Trains the self-supervised model with automatic "
+                                                                 "mixed precision (float16) and the channels_last_3d "
+                                                                 "memory format on GPU")
+    parser.add_argument("--compile_model", action="store_true", help="Compiles the self-supervised model with "
+                                                                       "torch.compile (PyTorch >= 2.0) on GPU")
 
     # Transfer Learning
     parser.add_argument("--pretrained_path", type=str)
@@ -225,7 +225,8 @@ class ResNet(nn.Module):
         return nn.Sequential(*layers)
 
     def forward(self, x):
-        self.inputs = x.detach().cpu().numpy()
+        # kept on device, get_current_visuals() callers copy it to the host
+        self.inputs = x.detach()
         x = self.conv1(x)
         x = self.bn1(x)
         x = self.relu(x)
@@ -1,8 +1,14 @@
-from dl_training.core import Base
+import os
+from functools import partial
+from dl_training.core import Base, inference_mode
 from datasets.open_bhb import OpenBHB, SubOpenBHB
 import torch
-from torch.utils.data import SequentialSampler
+import torch.distributed as dist
+import torch.nn.functional as func
+from torch.nn import DataParallel
+from torch.utils.data import SequentialSampler, DistributedSampler
 from dl_training.augmentation import *
+from dl_training.augmentation.intensity import gaussian_kernel1d
 from dl_training.transforms import Crop
 from tqdm import tqdm
 import numpy as np
@@ -14,7 +20,7 @@ class DA_Module(object):
         self.compose_transforms = Transformer()
 
         self.compose_transforms.register(flip, probability=0.5)
-        self.compose_transforms.register(add_blur, probability=0.5, sigma=(0.1, 1))
+        self.compose_transforms.register(add_blur, probability=0.5, sigma=(0.1, 1), nb_bins=16)
         self.compose_transforms.register(add_noise, sigma=(0.1, 1), probability=0.5)
         self.compose_transforms.register(cutout, probability=0.5, patch_size=32, inplace=False)
         self.compose_transforms.register(Crop((96, 96, 96), "random", resize=True), probability=0.5)
@@ -23,9 +29,115 @@ class DA_Module(object):
         return self.compose_transforms(x)
 
 
+class DA_Module_GPU(object):
+    """
+    Batched counterpart of DA_Module, applied on device after collate (the DataLoader workers only load the
+    raw images). Each transformation is drawn independently for each view of each sample. The random draws are
+    performed on device and each transformation is applied through a mask, so that the host never waits for the
+    device (no host-to-device copy of indices nor nonzero()). Only the crop offsets, used to slice the batch, are
+    drawn on CPU.
+    """
+    def __init__(self, crop_shape=(96, 96, 96), blur_sigma=(0.1, 1), noise_sigma=(0.1, 1), patch_size=32,
+                 probability=0.5, nb_blur_bins=16):
+        """
+        :param crop_shape: tuple of int, the shape of the random crop (resized to the input shape)
+        :param blur_sigma: 2-uplet, range of the standard deviation of the Gaussian blur
+        :param noise_sigma: 2-uplet, range of the standard deviation of the Gaussian noise
+        :param patch_size: int, size of the cutout patch
+        :param probability: float, probability to apply each transformation
+        :param nb_blur_bins: int, number of pre-computed Gaussian kernels spanning <blur_sigma>
+        """
+        self.crop_shape = crop_shape
+        self.noise_sigma = noise_sigma
+        self.patch_size = patch_size
+        self.probability = probability
+        # [nb_blur_bins + 1, K] Gaussian kernels zero-padded to the same size (a kernel is then selected per
+        # sample on device), the last one is the identity for the samples that are not blurred
+        kernels = [gaussian_kernel1d(float(s)) for s in np.linspace(blur_sigma[0], blur_sigma[1], nb_blur_bins)]
+        radius = max(len(k) for k in kernels) // 2
+        self.blur_kernels = torch.zeros((nb_blur_bins + 1, 2 * radius + 1))
+        for (i, kernel) in enumerate(kernels):
+            self.blur_kernels[i, radius - len(kernel) // 2: radius + len(kernel) // 2 + 1] = torch.from_numpy(kernel)
+        self.blur_kernels[-1, radius] = 1
+
+    def __call__(self, x):
+        """
+        :param x: torch.Tensor of shape (*, C, D, H, W), e.g (B, 2, C, D, H, W) for SimCLR
+        :return: the augmented tensor with the same shape
+        """
+        shape = x.shape
+        x = x.reshape(-1, *shape[-4:])
+        apply = torch.rand(5, len(x), device=x.device) < self.probability
+        for (i, transform) in enumerate([self.flip, self.blur, self.noise, self.cutout, self.crop]):
+            x = transform(x, apply[i])
+        return x.reshape(shape)
+
+    def flip(self, x, mask):
+        axes = torch.randint(3, (len(x),), device=x.device)
+        for axis in range(3):
+            x = torch.where((mask & (axes == axis)).view(-1, 1, 1, 1, 1), x.flip(2 + axis), x)
+        return x
+
+    def blur(self, x, mask):
+        if self.blur_kernels.device != x.device:
+            # moved once to the device
+            self.blur_kernels = self.blur_kernels.to(x.device)
+        (batch_size, channels), (nb_kernels, size) = x.shape[:2], self.blur_kernels.shape
+        bins = torch.randint(nb_kernels - 1, (batch_size,), device=x.device)
+        bins = torch.where(mask, bins, torch.full_like(bins, nb_kernels - 1))
+        kernels = self.blur_kernels[bins].to(x.dtype).repeat_interleave(channels, dim=0)
+        # separable convolution, one group per (sample, channel)
+        x_blurred = x.reshape(1, batch_size * channels, *x.shape[2:])
+        for axis in range(3):
+            weight_shape, pad = [batch_size * channels, 1, 1, 1, 1], [0] * 6
+            weight_shape[2 + axis] = size
+            pad[4 - 2 * axis: 6 - 2 * axis] = [size // 2, size // 2]
+            x_blurred = func.conv3d(func.pad(x_blurred, pad, mode="replicate"), kernels.view(weight_shape),
+                                    groups=batch_size * channels)
+        return x_blurred.view_as(x)
+
+    def noise(self, x, mask):
+        sigma = torch.empty(len(x), device=x.device, dtype=x.dtype).uniform_(*self.noise_sigma) * mask
+        return x + torch.randn_like(x) * sigma.view(-1, 1, 1, 1, 1)
+
+    def cutout(self, x, mask):
+        img_shape = x.shape[2:]
+        mask = mask.view(-1, 1, 1, 1, 1)
+        for axis, size in enumerate(img_shape):
+            patch_size = min(self.patch_size, size)
+            start = torch.randint(size - patch_size + 1, (len(x), 1), device=x.device)
+            r = torch.arange(size, device=x.device).view(1, -1)
+            axis_shape = [len(x), 1, 1, 1, 1]
+            axis_shape[2 + axis] = size
+            mask = mask & ((r >= start) & (r < start + patch_size)).view(axis_shape)
+        return x.masked_fill(mask, 0)
+
+    def crop(self, x, mask):
+        # The random crops all have the same shape: they are stacked and resized at once (trilinear)
+        img_shape = tuple(x.shape[2:])
+        crop_shape = [min(c, s) for (c, s) in zip(self.crop_shape, img_shape)]
+        starts = [torch.randint(s - c + 1, (len(x),)).tolist() for (c, s) in zip(crop_shape, img_shape)]
+        patches = torch.stack([x[i, :, d:d + crop_shape[0], h:h + crop_shape[1], w:w + crop_shape[2]]
+                               for (i, (d, h, w)) in enumerate(zip(*starts))])
+        patches = func.interpolate(patches, size=img_shape, mode="trilinear", align_corners=False)
+        return torch.where(mask.view(-1, 1, 1, 1, 1), patches, x)
+
+
+def worker_init_fn(worker_id):
+    """
+    Gives each DataLoader worker its own random generator, used by the DA_Module of the dataset, instead of
+    re-seeding the global NumPy random state for each sample.
+    """
+    worker_info = torch.utils.data.get_worker_info()
+    rng = np.random.default_rng(seed=os.getpid() * 1000 + worker_id)
+    transforms = worker_info.dataset.transforms
+    for tf in getattr(transforms, "transforms", [transforms]):
+        if isinstance(tf, DA_Module):
+            tf.compose_transforms.rng = rng
+
+
 class SimCLROpenBHB(OpenBHB):
     def __getitem__(self, idx: int):
-        np.random.seed()
         x1, y1 = super().__getitem__(idx)
         x2, y1 = super().__getitem__(idx)
         return np.stack((x1, x2), axis=0), y1
@@ -33,30 +145,177 @@ class SimCLROpenBHB(OpenBHB):
 
 class SimCLRSubOpenBHB(SubOpenBHB):
     def __getitem__(self, idx: int):
-        np.random.seed()
         x1, y1 = super().__getitem__(idx)
         x2, y1 = super().__getitem__(idx)
         return np.stack((x1, x2), axis=0), y1
 
 
+class GatherLayer(torch.autograd.Function):
+    """
+    Gathers a tensor from all the processes while back-propagating the gradients to each of them
+    (torch.distributed.all_gather does not).
+    """
+    @staticmethod
+    def forward(ctx, x):
+        # NCCL only gathers contiguous tensors (the views z[:, 0], z[:, 1] are strided)
+        x = x.contiguous()
+        output = [torch.zeros_like(x) for _ in range(dist.get_world_size())]
+        dist.all_gather(output, x)
+        return tuple(output)
+
+    @staticmethod
+    def backward(ctx, *grads):
+        all_grads = torch.stack(grads)
+        dist.all_reduce(all_grads)
+        return all_grads[dist.get_rank()]
+
+
+def all_gather(x):
+    """
+    :param x: torch.Tensor of shape (N, *), N must be the same on all processes (the SimCLR loaders of
+    OpenBHBDataManager split the data evenly across the processes with a DistributedSampler)
+    :return: x concatenated across all the processes if torch.distributed is initialized, x otherwise
+    """
+    if dist.is_available() and dist.is_initialized():
+        return torch.cat(GatherLayer.apply(x), dim=0)
+    return x
+
+
+class CUDAPrefetcher(object):
+    """ Iterates over a DataLoader (with pinned memory) and yields the pairs (inputs, labels) on device.
+    On GPU, the next batch is copied (and eventually augmented) on a side stream while the current one is processed.
+    """
+    def __init__(self, loader, device, transform=None):
+        self.loader = loader
+        self.device = device
+        self.transform = transform
+        self.stream = torch.cuda.Stream(device) if device.type == "cuda" else None
+        self.iterator = None
+        self.next_batch = None
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _load(self, dataitem):
+        inputs = dataitem.inputs.to(self.device, non_blocking=True)
+        labels = dataitem.labels.to(self.device, non_blocking=True) if dataitem.labels is not None else None
+        if self.transform is not None:
+            inputs = self.transform(inputs)
+        return inputs, labels
+
+    def preload(self):
+        dataitem = next(self.iterator, None)
+        if dataitem is None:
+            self.next_batch = None
+        elif self.stream is None:
+            self.next_batch = self._load(dataitem)
+        else:
+            with torch.cuda.stream(self.stream):
+                self.next_batch = self._load(dataitem)
+
+    def __iter__(self):
+        self.iterator = iter(self.loader)
+        self.preload()
+        while self.next_batch is not None:
+            batch = self.next_batch
+            if self.stream is not None:
+                current_stream = torch.cuda.current_stream(self.device)
+                current_stream.wait_stream(self.stream)
+                # the memory allocated on the side stream must not be reused before the current stream is done
+                for tensor in batch:
+                    if tensor is not None:
+                        tensor.record_stream(current_stream)
+            self.preload()
+            yield batch
+
+
 class SimCLR(Base):
+    def __init__(self, *args, data_augmentation=None, use_amp=False, compile_model=False, **kwargs):
+        """
+        :param data_augmentation: callable, default None. If set (e.g DA_Module_GPU), it is applied on device to
+        each batch of views before the forward pass.
+        :param use_amp: bool, default False. If True and the model runs on GPU, the forward pass is performed
+        with automatic mixed precision (float16) and the gradients are scaled accordingly. The state of the
+        gradient scaler is saved in the checkpoints and restored from <pretrained>. The model and its inputs also
+        use the channels_last_3d memory format, if supported by PyTorch.
+        :param compile_model: bool, default False. If True and the model runs on a single GPU, the forward pass is
+        compiled with torch.compile (PyTorch >= 2.0). The compilation is redone for a new input shape (e.g the last
+        batch, the validation set) and when switching between training and evaluation.
+        :param args, kwargs: given to Base
+        """
+        # the scaler exists before Base restores the <pretrained> checkpoint (see load_checkpoint_state)
+        self.use_amp = use_amp and kwargs.get("use_cuda", False)
+        # torch.autocast (PyTorch >= 1.10) and torch.amp.GradScaler (PyTorch >= 2.3) supersede the deprecated
+        # torch.cuda.amp ones
+        if hasattr(torch, "amp") and hasattr(torch.amp, "GradScaler"):
+            self.scaler = torch.amp.GradScaler("cuda", enabled=self.use_amp)
+        else:
+            self.scaler = torch.cuda.amp.GradScaler(enabled=self.use_amp)
+        if hasattr(torch, "autocast"):
+            self.autocast = partial(torch.autocast, "cuda", enabled=self.use_amp)
+        else:
+            self.autocast = partial(torch.cuda.amp.autocast, enabled=self.use_amp)
+        super().__init__(*args, **kwargs)
+        self.data_augmentation = data_augmentation
+        # NDHWC layout for the float16 3D convolutions (Tensor Cores), often slower than NCDHW in float32
+        self.memory_format = None
+        if self.use_amp and hasattr(torch, "channels_last_3d"):
+            self.memory_format = torch.channels_last_3d
+            self.model = self.model.to(memory_format=self.memory_format)
+        # The compiled module shares its parameters with self.model, which is kept for the checkpoints
+        self.forward_fn = self.model
+        if compile_model and self.device.type == "cuda" and hasattr(torch, "compile") and \
+                not isinstance(self.model, DataParallel):
+            # the first graph is static (2B views), a dynamic one is compiled if the batch size changes
+            # (last batch, validation set) rather than a new static graph per shape
+            self.forward_fn = torch.compile(self.model, mode="max-autotune", dynamic=None)
+        # Resolved once rather than at each batch
+        self._aux_loss_fn = getattr(self.loss, 'get_aux_losses', None)
+        # (logits, target) of the current epoch, the metrics are computed at its end (see flush_metrics)
+        self._metrics_buffer = []
+
+    def checkpoint_state(self):
+        return dict(scaler=self.scaler.state_dict())
+
+    def load_checkpoint_state(self, checkpoint):
+        # the scaler state is empty if AMP was disabled
+        if checkpoint.get("scaler"):
+            self.scaler.load_state_dict(checkpoint["scaler"])
+
     def get_output_pairs(self, inputs, **kwargs):
         """
-        :param inputs: torch.Tensor
+        :param inputs: torch.Tensor on device (B, 2, C, D, H, W)
         :return: pair (z_i, z_j) where z_i and z_j have the same structure as inputs
         """
-        z_i = self.model(inputs[:, 0, :].to(self.device))
-        z_j = self.model(inputs[:, 1, :].to(self.device))
-        return z_i, z_j
-
-    def update_metrics(self, values, nb_batch, logits=None, target=None, validation=False, **kwargs):
-        if logits is not None and target is not None:
-            for name, metric in self.metrics.items():
-                if validation:
-                    name = name + " on validation set"
-                if name not in values:
-                    values[name] = 0
-                values[name] += float(metric(logits, target)) / nb_batch
+        # a single forward pass on the 2B views (the batch norm statistics are computed on both views)
+        batch_size = inputs.size(0)
+        inputs = inputs.reshape(2 * batch_size, *inputs.shape[2:])
+        if self.memory_format is not None:
+            inputs = inputs.contiguous(memory_format=self.memory_format)
+        with self.autocast():
+            z = self.forward_fn(inputs)
+        # the loss is computed in float32 (its diagonal penalty overflows float16)
+        z = z.float().view(batch_size, 2, *z.shape[1:])
+        (z_i, z_j) = (z[:, 0], z[:, 1])
+        # in distributed mode, the loss is computed over the global batch (negatives from all processes)
+        return all_gather(z_i), all_gather(z_j)
+
+    def update_metrics(self, logits=None, target=None, **kwargs):
+        # kept on device to avoid a synchronization per batch and per metric
+        if logits is not None and target is not None and len(self.metrics) > 0:
+            self._metrics_buffer.append((logits.detach(), target.detach()))
+
+    def flush_metrics(self, values, nb_batch, validation=False):
+        """ Computes the metrics averaged over the batches buffered by update_metrics and empties the buffer.
+        The logits of each batch ([N, N] similarities) depend on its size, hence the metrics are computed per batch.
+        """
+        metrics = [(name + " on validation set" if validation else name, metric)
+                   for (name, metric) in self.metrics.items()]
+        for (logits, target) in self._metrics_buffer:
+            (logits, target) = (logits.cpu(), target.cpu())
+            for (name, metric) in metrics:
+                values[name] = values.get(name, 0) + float(metric(logits, target)) / nb_batch
+        self._metrics_buffer = []
 
     def train(self, loader, fold=None, epoch=None, **kwargs):
         """ Train the model on the dataloader provided
@@ -73,37 +332,49 @@ class SimCLR(Base):
         """
 
         self.model.train()
+        if isinstance(getattr(loader, "sampler", None), DistributedSampler) and epoch is not None:
+            # a different shuffling at each epoch (the same on all the processes)
+            loader.sampler.set_epoch(epoch)
         nb_batch = len(loader)
         pbar = tqdm(total=nb_batch, desc="Mini-Batch")
 
         values = {}
-        losses = []
-        for dataitem in loader:
+        # the losses are accumulated on device to avoid a synchronization at each batch
+        loss_sum = torch.zeros((), device=self.device)
+        aux_losses_sum = {}
+        self._metrics_buffer = []
+        for (inputs, labels) in CUDAPrefetcher(loader, self.device, transform=self.data_augmentation):
             pbar.update()
-            inputs = dataitem.inputs
-            labels = dataitem.labels.to(self.device) if dataitem.labels is not None else None
-            self.optimizer.zero_grad()
+            labels = all_gather(labels) if labels is not None else None
+            # Equivalent to zero_grad(set_to_none=True) (PyTorch >= 1.7): no memset, backward writes the grads
+            for group in self.optimizer.param_groups:
+                for p in group["params"]:
+                    p.grad = None
             (z_i, z_j) = self.get_output_pairs(inputs, **kwargs)
             if labels is not None:
                 batch_loss, *args = self.loss(z_i, z_j, labels)
             else:
                 batch_loss, *args = self.loss(z_i, z_j)
 
-            batch_loss.backward()
-            self.optimizer.step()
-
-            aux_losses = (self.loss.get_aux_losses() if hasattr(self.loss, 'get_aux_losses') else dict())
-            for name, aux_loss in aux_losses.items():
-                if name not in values:
-                    values[name] = 0
-                values[name] += float(aux_loss) / nb_batch
+            self.scaler.scale(batch_loss).backward()
+            self.scaler.step(self.optimizer)
+            self.scaler.update()
 
-            losses.append(float(batch_loss))
-            self.update_metrics(values, nb_batch, *args, **kwargs)
+            if self._aux_loss_fn is not None:
+                for name, aux_loss in self._aux_loss_fn().items():
+                    aux_losses_sum[name] = aux_losses_sum.get(name, 0) + \
+                                           (aux_loss.detach() if torch.is_tensor(aux_loss) else aux_loss)
 
-        loss = np.mean(losses)
+            loss_sum += batch_loss.detach()
+            self.update_metrics(*args, **kwargs)
 
         pbar.close()
+        self.flush_metrics(values, nb_batch)
+
+        loss = float(loss_sum) / nb_batch
+        for name, aux_loss in aux_losses_sum.items():
+            values[name] = float(aux_loss) / nb_batch
+
         return loss, values
 
     def test(self, loader, with_visuals=False, **kwargs):
@@ -126,32 +397,45 @@ class SimCLR(Base):
             the value of the loss function.
         values: dict
             the values of the metrics.
+        visuals: array-like
+            if <with_visuals>, the model's current visuals of the second view of each sample, e.g the augmented
+            inputs (N, C, D, H, W) for ResNet.
         """
 
         self.model.eval()
         nb_batch = len(loader)
         pbar = tqdm(total=nb_batch, desc="Mini-Batch")
-        loss = 0
+        loss_sum = torch.zeros((), device=self.device)
+        aux_losses_sum = {}
+        self._metrics_buffer = []
         values = {}
-        visuals = []
+        # The visuals are copied to a (pageable) host buffer pre-allocated at the first batch (they do not fit
+        # on device)
+        (visuals, offset) = (None, 0)
         y, y_true, X = [], [], []
 
-        with torch.no_grad():
-            for dataitem in loader:
+        with inference_mode():
+            for (inputs, labels) in CUDAPrefetcher(loader, self.device, transform=self.data_augmentation):
                 pbar.update()
-                inputs = dataitem.inputs
-                labels = dataitem.labels.to(self.device) if dataitem.labels is not None else None
+                labels = all_gather(labels) if labels is not None else None
 
                 (z_i, z_j) = self.get_output_pairs(inputs, **kwargs)
                 if with_visuals:
-                    visuals.append(self.model.get_current_visuals())
+                    # second view of each sample (the model sees the 2B interleaved views)
+                    current_visuals = self.model.get_current_visuals()
+                    current_visuals = current_visuals.reshape(-1, 2, *current_visuals.shape[1:])[:, 1]
+                    if visuals is None:
+                        visuals = torch.empty((len(loader.sampler), *current_visuals.shape[1:]),
+                                              dtype=current_visuals.dtype)
+                    visuals[offset:offset + len(current_visuals)].copy_(current_visuals)
+                    offset += len(current_visuals)
 
                 if labels is not None:
                     batch_loss, *args = self.loss(z_i, z_j, labels)
                 else:
                     batch_loss, *args = self.loss(z_i, z_j)
 
-                loss += float(batch_loss) / nb_batch
+                loss_sum += batch_loss.detach()
                 #y.extend(logits.detach().cpu().numpy())
                 #y_true.extend(target.detach().cpu().numpy())
 
@@ -159,22 +443,23 @@ class SimCLR(Base):
                 #for i in inputs:
                 #    X.extend(i.cpu().detach().numpy())
 
-                # Now computes the metrics with (y, y_true)
-                self.update_metrics(values, nb_batch, *args, validation=True, **kwargs)
+                # Buffers (logits, target), the metrics are computed at the end
+                self.update_metrics(*args, **kwargs)
 
-                aux_losses = (self.loss.get_aux_losses() if hasattr(self.loss, 'get_aux_losses') else dict())
-                for name, aux_loss in aux_losses.items():
-                    name += " on validation set"
-                    if name not in values:
-                        values[name] = 0
-                    values[name] += aux_loss / nb_batch
+                if self._aux_loss_fn is not None:
+                    for name, aux_loss in self._aux_loss_fn().items():
+                        aux_losses_sum[name] = aux_losses_sum.get(name, 0) + \
+                                               (aux_loss.detach() if torch.is_tensor(aux_loss) else aux_loss)
 
         pbar.close()
+        self.flush_metrics(values, nb_batch, validation=True)
 
-        if len(visuals) > 0:
-            visuals = np.concatenate(visuals, axis=0)
+        loss = float(loss_sum) / nb_batch
+        for name, aux_loss in aux_losses_sum.items():
+            values[name + " on validation set"] = float(aux_loss) / nb_batch
 
         if with_visuals:
+            visuals = visuals[:offset].numpy() if visuals is not None else np.empty(0)
             return y, y_true, X, loss, values, visuals
 
         return y, y_true, X, loss, values
\ No newline at end of file
@@ -1,11 +1,13 @@
 from dl_training.core import Base
 from dl_training.datamanager import OpenBHBDataManager, BHBDataManager, ClinicalDataManager
-from dl_training.self_supervision.sim_clr import SimCLR
+from dl_training.self_supervision.sim_clr import SimCLR, DA_Module_GPU
 from dl_training.models.resnet import *
 from dl_training.models.densenet import *
 from dl_training.losses import *
 from dl_training.models.sfcn import SFCN
 from dl_training.models.alexnet import AlexNet3D_Dropout
+from torch.utils.data import DataLoader
+from inspect import signature
 import nibabel, os
 
 
@@ -23,6 +25,12 @@ class BaseTrainer():
                                                          step_size=args.step_size_scheduler)
         model_cls = SimCLR if args.pb == "self_supervised" else Base
         self.kwargs_train = dict()
+        kwargs_model = dict()
+        if args.pb == "self_supervised":
+            kwargs_model["use_amp"] = args.use_amp
+            kwargs_model["compile_model"] = args.compile_model
+            if args.da_on_gpu:
+                kwargs_model["data_augmentation"] = DA_Module_GPU()
 
         self.model = model_cls(model=self.net,
                                metrics=self.metrics,
@@ -30,7 +38,8 @@ class BaseTrainer():
                                load_optimizer=args.load_optimizer,
                                use_cuda=args.cuda,
                                loss=self.loss,
-                               optimizer=self.optimizer)
+                               optimizer=self.optimizer,
+                               **kwargs_model)
 
     def run(self):
         with_validation = True
@@ -142,6 +151,9 @@ class BaseTrainer():
                               residualize=args.residualize, mask=mask, number_of_folds=args.nb_folds,
                               N_train_max=args.N_train_max, device=('cuda' if args.cuda else 'cpu'),
                               num_workers=args.num_cpu_workers, pin_memory=True, drop_last=False)
+        if args.num_cpu_workers > 0 and "persistent_workers" in signature(DataLoader).parameters:
+            # keeps the workers alive across epochs and loads several batches in advance (PyTorch >= 1.7)
+            kwargs_manager.update(persistent_workers=True, prefetch_factor=args.prefetch_factor)
 
         if args.pb in ["age", "sex", "self_supervised"]:
             kwargs_manager["model"] = "SimCLR" if args.pb == "self_supervised" else "base"
@@ -10,6 +10,7 @@ import numpy as np
 from scipy.ndimage import rotate, affine_transform
 from skimage import transform as sk_tf
 import torch
+from dl_training.augmentation.utils import get_rng
 
 class Scaler(object):
     def __init__(self, scale=1):
@@ -207,10 +208,26 @@ class Crop(object):
         self.resize=resize
         self.keep_dim=keep_dim
 
-    def __call__(self, arr):
+    def __call__(self, arr, rng=None):
+        """ Crop an array.
+
+        Parameters
+        ----------
+        arr: np.array
+            an input array.
+        rng: numpy.random.Generator, default None
+            the random number generator used for 'random' crops.
+
+        Returns
+        -------
+        arr_cropped: np.array
+            the cropped (and eventually resized) array.
+        """
         assert isinstance(arr, np.ndarray)
         assert type(self.shape) == int or len(self.shape) == len(arr.shape), "Shape of array {} does not match {}".\
             format(arr.shape, self.shape)
+        if self.copping_type == "random":
+            rng = get_rng(rng)
 
         img_shape = np.array(arr.shape)
         if type(self.shape) == int:
@@ -224,7 +241,7 @@ class Crop(object):
             if self.copping_type == "center":
                 delta_before = int((img_shape[ndim] - size[ndim]) / 2.0)
             elif self.copping_type == "random":
-                delta_before = np.random.randint(0, img_shape[ndim] - size[ndim] + 1)
+                delta_before = rng.integers(0, img_shape[ndim] - size[ndim] + 1)
             indexes.append(slice(delta_before, delta_before + size[ndim]))
         if self.resize:
             # resize the image to the input shape